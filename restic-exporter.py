@@ -1,19 +1,146 @@
 #!/usr/bin/env python3
+import asyncio
 import datetime
 import hashlib
 import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-
+from collections import Counter, OrderedDict
+
+import ijson
+try:
+    # orjson is faster, fallback to the standard library if it's not installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 from prometheus_client import start_http_server
 from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
 from prometheus_client.registry import Collector
 
+# Maximum number of snapshot stats kept in the cache
+STATS_CACHE_MAX_SIZE = 10000
+# Stats of each backup when NO_STATS is enabled, -1 is the "no-stats" value
+DISABLED_STATS = {
+    "total_size": -1,
+    "total_file_count": -1,
+}
+# Lock ids printed by restic list locks
+LOCK_ID_PATTERN = re.compile(rb"^[a-z0-9]+$")
+
+# Exported metrics: (metrics key, family type, name, documentation)
+REPOSITORY_METRICS = [
+    (
+        "check_success",
+        GaugeMetricFamily,
+        "restic_check_success",
+        "Result of restic check operation in the repository",
+    ),
+    (
+        "locks_total",
+        CounterMetricFamily,
+        "restic_locks_total",
+        "Total number of locks in the repository",
+    ),
+    (
+        "snapshots_total",
+        CounterMetricFamily,
+        "restic_snapshots_total",
+        "Total number of snapshots in the repository",
+    ),
+    (
+        "duration",
+        GaugeMetricFamily,
+        "restic_scrape_duration_seconds",
+        "Amount of time each scrape takes",
+    ),
+]
+CLIENT_METRICS = [
+    (
+        "timestamp",
+        GaugeMetricFamily,
+        "restic_backup_timestamp",
+        "Timestamp of the last backup",
+    ),
+    (
+        "files_total",
+        CounterMetricFamily,
+        "restic_backup_files_total",
+        "Number of files in the backup",
+    ),
+    (
+        "size_total",
+        CounterMetricFamily,
+        "restic_backup_size_total",
+        "Total size of backup in bytes",
+    ),
+    (
+        "snapshots_total",
+        CounterMetricFamily,
+        "restic_backup_snapshots_total",
+        "Total number of snapshots",
+    ),
+    (
+        "duration_seconds",
+        GaugeMetricFamily,
+        "restic_backup_duration_seconds",
+        "Amount of time each backup takes",
+    ),
+    (
+        "files_new",
+        GaugeMetricFamily,
+        "restic_backup_files_new",
+        "Number of new files in the backup",
+    ),
+    (
+        "files_changed",
+        GaugeMetricFamily,
+        "restic_backup_files_changed",
+        "Number of changed files in the backup",
+    ),
+    (
+        "files_unmodified",
+        GaugeMetricFamily,
+        "restic_backup_files_unmodified",
+        "Number of unmodified files in the backup",
+    ),
+    (
+        "total_files_processed",
+        GaugeMetricFamily,
+        "restic_backup_files_processed",
+        "Number of files processed in the last backup",
+    ),
+    (
+        "total_bytes_processed",
+        GaugeMetricFamily,
+        "restic_backup_bytes_processed",
+        "Number of bytes processed in the last backup",
+    ),
+    (
+        "total_bytes_added",
+        GaugeMetricFamily,
+        "restic_backup_bytes_added",
+        "Number of bytes added in the last backup",
+    ),
+]
+# Label names of the client metrics, in the order of client["labels"]
+COMMON_LABEL_NAMES = [
+    "client_hostname",
+    "client_username",
+    "client_version",
+    "snapshot_hash",
+    "snapshot_tag",
+    "snapshot_tags",
+    "snapshot_paths",
+]
+
 
 class ResticCollector(Collector):
     def __init__(
@@ -26,6 +153,11 @@ class ResticCollector(Collector):
         disable_locks,
         include_paths,
         insecure_tls,
+        restic_concurrency,
+        cache_path,
+        check_ttl,
+        locks_ttl,
+        snapshots_ttl,
     ):
         self.repository = repository
         self.password_file = password_file
@@ -35,174 +167,47 @@ class ResticCollector(Collector):
         self.disable_locks = disable_locks
         self.include_paths = include_paths
         self.insecure_tls = insecure_tls
-        # todo: the stats cache increases over time -> remove old ids
-        # todo: cold start -> the stats cache could be saved in a persistent volume
+        self.restic_concurrency = restic_concurrency
+        self.cache_path = cache_path
+        self.check_ttl = check_ttl
+        self.locks_ttl = locks_ttl
+        self.snapshots_ttl = snapshots_ttl
+        # arguments shared by all the restic commands. The executable is
+        # resolved once instead of searching the PATH in every command.
+        self.base_args = [
+            shutil.which("restic") or "restic",
+            "-r",
+            repository,
+            "-p",
+            password_file,
+            "--no-lock",
+        ]
+        self.tls_args = ["--insecure-tls"] if insecure_tls else []
         # todo: cold start -> the restic cache (/root/.cache/restic) could be
         # saved in a persistent volume
-        self.stats_cache = {}
-        self.metrics = {}
+        self.stats_cache = self.load_stats_cache()
+        # {key: (expiry_time, value)} for the results of slow restic commands
+        self.ttl_cache = {}
+        # the metric families are built once per refresh and served in
+        # every scrape, the lock swaps them with the HTTP server thread
+        self.metric_families = []
+        self.metric_families_lock = threading.Lock()
         self.refresh(exit_on_error)
 
     def collect(self):
-        logging.debug("Incoming request")
-
-        common_label_names = [
-            "client_hostname",
-            "client_username",
-            "client_version",
-            "snapshot_hash",
-            "snapshot_tag",
-            "snapshot_tags",
-            "snapshot_paths",
-        ]
-
-        check_success = GaugeMetricFamily(
-            "restic_check_success",
-            "Result of restic check operation in the repository",
-            labels=[],
-        )
-        locks_total = CounterMetricFamily(
-            "restic_locks_total",
-            "Total number of locks in the repository",
-            labels=[],
-        )
-        snapshots_total = CounterMetricFamily(
-            "restic_snapshots_total",
-            "Total number of snapshots in the repository",
-            labels=[],
-        )
-        backup_timestamp = GaugeMetricFamily(
-            "restic_backup_timestamp",
-            "Timestamp of the last backup",
-            labels=common_label_names,
-        )
-        backup_files_total = CounterMetricFamily(
-            "restic_backup_files_total",
-            "Number of files in the backup",
-            labels=common_label_names,
-        )
-        backup_size_total = CounterMetricFamily(
-            "restic_backup_size_total",
-            "Total size of backup in bytes",
-            labels=common_label_names,
-        )
-        backup_snapshots_total = CounterMetricFamily(
-            "restic_backup_snapshots_total",
-            "Total number of snapshots",
-            labels=common_label_names,
-        )
-        backup_files_new = GaugeMetricFamily(
-            "restic_backup_files_new",
-            "Number of new files in the backup",
-            labels=common_label_names
-        )
-        backup_files_changed = GaugeMetricFamily(
-            "restic_backup_files_changed",
-            "Number of changed files in the backup",
-            labels=common_label_names
-        )
-        backup_files_unmodified = GaugeMetricFamily(
-            "restic_backup_files_unmodified",
-            "Number of unmodified files in the backup",
-            labels=common_label_names
-        )
-        backup_files_processed = GaugeMetricFamily(
-            "restic_backup_files_processed",
-            "Number of files processed in the last backup",
-            labels=common_label_names
-        )
-        backup_bytes_processed = GaugeMetricFamily(
-            "restic_backup_bytes_processed",
-            "Number of bytes processed in the last backup",
-            labels=common_label_names
-        )
-        backup_bytes_added = GaugeMetricFamily(
-            "restic_backup_bytes_added",
-            "Number of bytes added in the last backup",
-            labels=common_label_names
-        )
-        backup_duration_seconds = GaugeMetricFamily(
-            "restic_backup_duration_seconds",
-            "Amount of time each backup takes",
-            labels=common_label_names
-        )
-        scrape_duration_seconds = GaugeMetricFamily(
-            "restic_scrape_duration_seconds",
-            "Amount of time each scrape takes",
-            labels=[],
-        )
-
-        check_success.add_metric([], self.metrics["check_success"])
-        locks_total.add_metric([], self.metrics["locks_total"])
-        snapshots_total.add_metric([], self.metrics["snapshots_total"])
-
-        for client in self.metrics["clients"]:
-            common_label_values = [
-                client["hostname"],
-                client["username"],
-                client["version"],
-                client["snapshot_hash"],
-                client["snapshot_tag"],
-                client["snapshot_tags"],
-                client["snapshot_paths"],
-            ]
-
-            backup_timestamp.add_metric(
-                common_label_values, client["timestamp"])
-            backup_files_total.add_metric(
-                common_label_values, client["files_total"])
-            backup_size_total.add_metric(
-                common_label_values, client["size_total"])
-            backup_snapshots_total.add_metric(
-                common_label_values, client["snapshots_total"]
-            )
-
-            # Snapshot specific metrics
-            backup_files_new.add_metric(
-                common_label_values, client["files_new"]
-            )
-            backup_files_changed.add_metric(
-                common_label_values, client["files_changed"]
-            )
-            backup_files_unmodified.add_metric(
-                common_label_values, client["files_unmodified"]
-            )
-            backup_files_processed.add_metric(
-                common_label_values, client["total_files_processed"]
-            )
-            backup_bytes_processed.add_metric(
-                common_label_values, client["total_bytes_processed"]
-            )
-            backup_bytes_added.add_metric(
-                common_label_values, client["total_bytes_added"]
-            )
-
-            # Scrape duration
-            backup_duration_seconds.add_metric(
-                common_label_values, client["duration_seconds"]
-            )
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Incoming request")
 
-        scrape_duration_seconds.add_metric([], self.metrics["duration"])
-
-        yield check_success
-        yield locks_total
-        yield snapshots_total
-        yield backup_timestamp
-        yield backup_files_total
-        yield backup_size_total
-        yield backup_snapshots_total
-        yield backup_duration_seconds
-        yield backup_files_new
-        yield backup_files_changed
-        yield backup_files_unmodified
-        yield backup_files_processed
-        yield backup_bytes_processed
-        yield backup_bytes_added
-        yield scrape_duration_seconds
+        with self.metric_families_lock:
+            metric_families = self.metric_families
+        yield from metric_families
 
     def refresh(self, exit_on_error=False):
         try:
-            self.metrics = self.get_metrics()
+            metrics = asyncio.run(self.get_metrics())
+            metric_families = self.build_metric_families(metrics)
+            with self.metric_families_lock:
+                self.metric_families = metric_families
         except Exception:
             logging.error(
                 "Unable to collect metrics from Restic. %s",
@@ -213,97 +218,46 @@ class ResticCollector(Collector):
             if exit_on_error:
                 sys.exit(1)
 
-    def get_metrics(self):
-        duration = time.time()
+    @staticmethod
+    def build_metric_families(metrics):
+        metric_families = []
 
-        # calc total number of snapshots per hash
-        all_snapshots = self.get_snapshots()
-        snap_total_counter = {}
-        for snap in all_snapshots:
-            if snap["hash"] not in snap_total_counter:
-                snap_total_counter[snap["hash"]] = 1
-            else:
-                snap_total_counter[snap["hash"]] += 1
+        for key, family_type, name, documentation in REPOSITORY_METRICS:
+            family = family_type(name, documentation, labels=[])
+            family.add_metric([], metrics[key])
+            metric_families.append(family)
 
-        # get the latest snapshot per hash
-        latest_snapshots_dup = self.get_snapshots(True)
-        latest_snapshots = {}
-        for snap in latest_snapshots_dup:
-            timestamp = time.mktime(
-                datetime.datetime.fromisoformat(snap["time"]).timetuple())
-            snap["timestamp"] = timestamp
-            if (
-                snap["hash"] not in latest_snapshots
-                or snap["timestamp"] > latest_snapshots[snap["hash"]]["timestamp"]
-            ):
-                latest_snapshots[snap["hash"]] = snap
+        for key, family_type, name, documentation in CLIENT_METRICS:
+            family = family_type(name, documentation, labels=COMMON_LABEL_NAMES)
+            for client in metrics["clients"]:
+                family.add_metric(client["labels"], client[key])
+            metric_families.append(family)
 
-        clients = []
-        for snap in list(latest_snapshots.values()):
-            # collect stats for each snap only if enabled
-            if self.disable_stats:
-                # return zero as "no-stats" value
-                stats = {
-                    "total_size": -1,
-                    "total_file_count": -1,
-                }
-            else:
-                stats = self.get_stats(snap["id"])
+        return metric_families
 
-            clients.append(
-                {
-                    "hostname": snap["hostname"],
-                    "username": snap["username"],
-                    "version": (
-                        snap["program_version"] if "program_version" in snap else ""
-                    ),
-                    "snapshot_hash": snap["hash"],
-                    "snapshot_tag": snap["tags"][0] if "tags" in snap else "",
-                    "snapshot_tags": ",".join(snap["tags"]) if "tags" in snap else "",
-                    "snapshot_paths": (
-                        ",".join(snap["paths"]) if self.include_paths else ""
-                    ),
-                    "timestamp": snap["timestamp"],
-                    "size_total": stats["total_size"],
-                    "files_total": stats["total_file_count"],
-                    "files_new": self.get_summary(snap, "files_new"),
-                    "files_changed": self.get_summary(snap, "files_changed"),
-                    "files_unmodified": self.get_summary(snap, "files_unmodified"),
-                    "total_files_processed": self.get_summary(
-                        snap, "total_files_processed"
-                    ),
-                    "total_bytes_processed": self.get_summary(
-                        snap, "total_bytes_processed"
-                    ),
-                    "total_bytes_added": self.get_summary(
-                        snap, "data_added"
-                    ),
-                    "snapshots_total": snap_total_counter[snap["hash"]],
-                    "duration_seconds": self.calc_duration(snap)
-                }
+    async def get_metrics(self):
+        duration = time.time()
+        # limit the number of restic commands running at the same time
+        self.restic_semaphore = asyncio.Semaphore(self.restic_concurrency)
+
+        # the restic commands are independent, run them concurrently
+        (snapshots_total, clients), check_success, locks_total = (
+            await self.gather_restic(
+                self.get_clients(),
+                self.get_check_success(),
+                self.get_locks_total(),
             )
+        )
 
         # todo: fix the commented code when the bug is fixed in restic
         #  https://github.com/restic/restic/issues/2126
         # stats = self.get_stats()
 
-        if self.disable_check:
-            # return 2 as "no-check" value
-            check_success = 2
-        else:
-            check_success = self.get_check()
-
-        if self.disable_locks:
-            # return 0 as "no-locks" value
-            locks_total = 0
-        else:
-            locks_total = self.get_locks()
-
         metrics = {
             "check_success": check_success,
             "locks_total": locks_total,
             "clients": clients,
-            "snapshots_total": len(all_snapshots),
+            "snapshots_total": snapshots_total,
             "duration": time.time() - duration,
             # 'size_total': stats['total_size'],
             # 'files_total': stats['total_file_count'],
@@ -311,92 +265,206 @@ class ResticCollector(Collector):
 
         return metrics
 
-    def get_snapshots(self, only_latest=False):
-        cmd = [
-            "restic",
-            "-r",
-            self.repository,
-            "-p",
-            self.password_file,
-            "--no-lock",
-            "snapshots",
-            "--json",
-        ]
+    async def get_clients(self):
+        # total number of snapshots and the count and latest snapshot per hash
+        snapshots_total, snap_total_counter, latest_snapshots = (
+            await self.get_cached(
+                "snapshots", self.snapshots_ttl, self.get_snapshots)
+        )
 
-        if only_latest:
-            cmd.extend(["--latest", "1"])
+        # collect stats for each snap only if enabled. The restic stats
+        # command is slow, run the uncached ones concurrently
+        snap_stats = {}
+        if not self.disable_stats:
+            uncached_ids = []
+            for snap in latest_snapshots.values():
+                if snap["id"] in self.stats_cache:
+                    self.stats_cache.move_to_end(snap["id"])
+                    snap_stats[snap["id"]] = self.stats_cache[snap["id"]]
+                else:
+                    uncached_ids.append(snap["id"])
+            if uncached_ids:
+                uncached_stats = await self.gather_restic(
+                    *(self.get_stats(snap_id) for snap_id in uncached_ids)
+                )
+                snap_stats.update(zip(uncached_ids, uncached_stats))
+                self.save_stats_cache()
 
-        if self.insecure_tls:
-            cmd.extend(["--insecure-tls"])
+        clients = []
+        for snap in latest_snapshots.values():
+            if self.disable_stats:
+                stats = DISABLED_STATS
+            else:
+                stats = snap_stats[snap["id"]]
 
-        result = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            raise Exception(
-                "Error executing restic snapshot command: " +
-                self.parse_stderr(result)
+            snap_hash = snap["hash"]
+            summary = snap.get("summary") or {}
+            tags = snap.get("tags") or [""]
+            paths = ",".join(snap["paths"]) if self.include_paths else ""
+
+            clients.append(
+                {
+                    "labels": [
+                        snap["hostname"],
+                        snap["username"],
+                        snap.get("program_version", ""),
+                        snap_hash,
+                        tags[0],
+                        ",".join(tags),
+                        paths,
+                    ],
+                    "timestamp": snap["timestamp"],
+                    "size_total": stats["total_size"],
+                    "files_total": stats["total_file_count"],
+                    "files_new": summary.get("files_new", 0),
+                    "files_changed": summary.get("files_changed", 0),
+                    "files_unmodified": summary.get("files_unmodified", 0),
+                    "total_files_processed": summary.get("total_files_processed", 0),
+                    "total_bytes_processed": summary.get("total_bytes_processed", 0),
+                    "total_bytes_added": summary.get("data_added", 0),
+                    "snapshots_total": snap_total_counter[snap_hash],
+                    "duration_seconds": self.calc_duration(summary)
+                }
             )
-        snapshots = json.loads(result.stdout.decode("utf-8"))
-        for snap in snapshots:
-            if "username" not in snap:
-                snap["username"] = ""
-            snap["hash"] = self.calc_snapshot_hash(snap)
-        return snapshots
-
-    def get_stats(self, snapshot_id=None):
+
+        return snapshots_total, clients
+
+    async def get_check_success(self):
+        if self.disable_check:
+            # return 2 as "no-check" value
+            return 2
+        check_success = await self.get_cached(
+            "check", self.check_ttl, self.get_check)
+        if check_success == 0:
+            # do not wait for the TTL to check the repository again
+            self.ttl_cache.pop("check")
+        return check_success
+
+    async def get_locks_total(self):
+        if self.disable_locks:
+            # return 0 as "no-locks" value
+            return 0
+        return await self.get_cached("locks", self.locks_ttl, self.get_locks)
+
+    @staticmethod
+    async def gather_restic(*aws):
+        # wait for all the commands before raising the first error, the
+        # restic processes would be left behind if they are cancelled
+        results = await asyncio.gather(*aws, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    async def get_cached(self, key, ttl, func, *args):
+        now = time.monotonic()
+        if key in self.ttl_cache:
+            expiry_time, value = self.ttl_cache[key]
+            if now < expiry_time:
+                return value
+        value = await func(*args)
+        self.ttl_cache[key] = (now + ttl, value)
+        return value
+
+    async def run_restic(self, cmd, stdout=subprocess.PIPE):
+        async with self.restic_semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=stdout, stderr=subprocess.PIPE)
+            stdout, stderr = await proc.communicate()
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+    async def get_snapshots(self):
+        cmd = [*self.base_args, "snapshots", "--json", *self.tls_args]
+
+        # The output is parsed while it's read to avoid loading the whole JSON
+        # in memory. Stderr is read in the background to avoid blocking restic.
+        # Only the latest snapshot per hash is kept, the rest are just counted.
+        snapshots_total = 0
+        snap_total_counter = Counter()
+        latest_snapshots = {}
+        async with self.restic_semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stderr_task = asyncio.create_task(proc.stderr.read())
+            try:
+                try:
+                    async for snap in ijson.items_async(
+                        proc.stdout, "item", use_float=True
+                    ):
+                        if "username" not in snap:
+                            snap["username"] = ""
+                        snap_hash = snap["hash"] = self.calc_snapshot_hash(snap)
+                        if not self.include_paths:
+                            # the paths are only needed for the hash
+                            del snap["paths"]
+                        snap["timestamp"] = datetime.datetime.fromisoformat(
+                            snap["time"]).timestamp()
+
+                        snapshots_total += 1
+                        snap_total_counter[snap_hash] += 1
+                        latest_snap = latest_snapshots.get(snap_hash)
+                        if (
+                            latest_snap is None
+                            or snap["timestamp"] > latest_snap["timestamp"]
+                        ):
+                            latest_snapshots[snap_hash] = snap
+                except ijson.JSONError:
+                    await proc.stdout.read()
+                    if await proc.wait() == 0:
+                        raise
+                await proc.wait()
+            finally:
+                # do not leave restic running if the output can't be processed
+                if proc.returncode is None:
+                    try:
+                        proc.kill()
+                    except ProcessLookupError:
+                        pass
+                    await proc.wait()
+                stderr = await stderr_task
+            if proc.returncode != 0:
+                result = subprocess.CompletedProcess(
+                    cmd, proc.returncode, stderr=stderr)
+                raise Exception(
+                    "Error executing restic snapshot command: " +
+                    self.parse_stderr(result)
+                )
+        return snapshots_total, snap_total_counter, latest_snapshots
+
+    async def get_stats(self, snapshot_id=None):
         # This command is expensive in CPU/Memory (1-5 seconds),
         # and much more when snapshot_id=None (3 minutes) -> we avoid this call for now
         # https://github.com/restic/restic/issues/2126
         if snapshot_id is not None and snapshot_id in self.stats_cache:
             return self.stats_cache[snapshot_id]
 
-        cmd = [
-            "restic",
-            "-r",
-            self.repository,
-            "-p",
-            self.password_file,
-            "--no-lock",
-            "stats",
-            "--json",
-        ]
+        cmd = [*self.base_args, "stats", "--json"]
         if snapshot_id is not None:
-            cmd.extend([snapshot_id])
+            cmd.append(snapshot_id)
+        cmd.extend(self.tls_args)
 
-        if self.insecure_tls:
-            cmd.extend(["--insecure-tls"])
-
-        result = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = await self.run_restic(cmd)
         if result.returncode != 0:
             raise Exception(
                 "Error executing restic stats command: " +
                 self.parse_stderr(result)
             )
-        stats = json.loads(result.stdout.decode("utf-8"))
+        stats = json_loads(result.stdout)
 
         if snapshot_id is not None:
             self.stats_cache[snapshot_id] = stats
+            # remove the least recently used ids
+            while len(self.stats_cache) > STATS_CACHE_MAX_SIZE:
+                self.stats_cache.popitem(last=False)
 
         return stats
 
-    def get_check(self):
+    async def get_check(self):
         # This command takes 20 seconds or more, but it's required
-        cmd = [
-            "restic",
-            "-r",
-            self.repository,
-            "-p",
-            self.password_file,
-            "--no-lock",
-            "check",
-        ]
-
-        if self.insecure_tls:
-            cmd.extend(["--insecure-tls"])
+        cmd = [*self.base_args, "check", *self.tls_args]
 
-        result = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # the output is not used, only the errors
+        result = await self.run_restic(cmd, stdout=subprocess.DEVNULL)
         if result.returncode == 0:
             return 1  # ok
         else:
@@ -406,50 +474,80 @@ class ResticCollector(Collector):
             )
             return 0  # error
 
-    def get_locks(self):
-        cmd = [
-            "restic",
-            "-r",
-            self.repository,
-            "-p",
-            self.password_file,
-            "--no-lock",
-            "list",
-            "locks",
-        ]
+    async def get_locks(self):
+        cmd = [*self.base_args, "list", "locks", *self.tls_args]
 
-        if self.insecure_tls:
-            cmd.extend(["--insecure-tls"])
-
-        result = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = await self.run_restic(cmd)
         if result.returncode != 0:
             raise Exception(
                 "Error executing restic list locks command: "
                 + self.parse_stderr(result)
             )
-        text_result = result.stdout.decode("utf-8")
-        lock_counter = 0
-        for line in text_result.split("\n"):
-            if re.match("^[a-z0-9]+$", line):
-                lock_counter += 1
+        return sum(
+            1 for line in result.stdout.splitlines() if LOCK_ID_PATTERN.match(line)
+        )
 
-        return lock_counter
+    def load_stats_cache(self):
+        # Snapshot ids are immutable, the stats can be reused between restarts
+        stats_cache = OrderedDict()
+        if not self.cache_path:
+            return stats_cache
+        try:
+            with open(self.cache_path, "r") as f:
+                stats_cache.update(json.load(f))
+            logging.info(
+                "Loaded {0} snapshot stats from cache file {1}".format(
+                    len(stats_cache), self.cache_path)
+            )
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logging.warning(
+                "Unable to load the stats cache file. %s",
+                traceback.format_exc(0).replace("\n", " "),
+            )
+        return stats_cache
 
-    def get_summary(self, snap, metric):
-        if "summary" in snap:
-            return snap["summary"].get(metric, 0)
-        return 0
+    def save_stats_cache(self):
+        if not self.cache_path:
+            return
+        temp_path = None
+        try:
+            cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file and rename it to avoid corrupted files
+            with tempfile.NamedTemporaryFile(
+                "w", dir=cache_dir, delete=False
+            ) as f:
+                temp_path = f.name
+                json.dump(self.stats_cache, f)
+            os.replace(temp_path, self.cache_path)
+            temp_path = None
+        except Exception:
+            logging.warning(
+                "Unable to save the stats cache file. %s",
+                traceback.format_exc(0).replace("\n", " "),
+            )
+        finally:
+            # do not leave the temporary file behind if the rename failed
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
 
     @staticmethod
     def calc_snapshot_hash(snapshot: dict) -> str:
-        text = snapshot["hostname"] + \
-            snapshot["username"] + ",".join(snapshot["paths"])
-        return hashlib.sha256(text.encode("utf-8")).hexdigest()
-
-    def calc_duration(self, snapshot: dict) -> float:
-        backup_start = snapshot.get('summary', {}).get('backup_start')
-        backup_end = snapshot.get('summary', {}).get('backup_end')
+        # feed the fields one by one to avoid concatenating strings,
+        # the digest is the same as hashing hostname + username + paths
+        snapshot_hash = hashlib.sha256(snapshot["hostname"].encode("utf-8"))
+        snapshot_hash.update(snapshot["username"].encode("utf-8"))
+        snapshot_hash.update(",".join(snapshot["paths"]).encode("utf-8"))
+        return snapshot_hash.hexdigest()
+
+    def calc_duration(self, summary: dict) -> float:
+        backup_start = summary.get('backup_start')
+        backup_end = summary.get('backup_end')
         if not backup_start or not backup_end:
             return 0.0
         try:
@@ -464,7 +562,7 @@ class ResticCollector(Collector):
     @staticmethod
     def parse_stderr(result):
         return (
-            result.stderr.decode("utf-8").replace("\n", " ")
+            result.stderr.decode("utf-8", errors="replace").replace("\n", " ")
             + " Exit code: "
             + str(result.returncode)
         )
@@ -515,6 +613,16 @@ if __name__ == "__main__":
     exporter_disable_locks = bool(os.environ.get("NO_LOCKS", False))
     exporter_include_paths = bool(os.environ.get("INCLUDE_PATHS", False))
     exporter_insecure_tls = bool(os.environ.get("INSECURE_TLS", False))
+    exporter_restic_concurrency = int(os.environ.get("RESTIC_CONCURRENCY", 8))
+    if exporter_restic_concurrency < 1:
+        logging.error(
+            "The environment variable RESTIC_CONCURRENCY must be at least 1")
+        sys.exit(1)
+    exporter_cache_path = os.environ.get(
+        "CACHE_PATH", "/var/cache/restic-exporter/stats.json")
+    exporter_check_ttl = int(os.environ.get("CHECK_TTL", 3600))
+    exporter_locks_ttl = int(os.environ.get("LOCKS_TTL", 30))
+    exporter_snapshots_ttl = int(os.environ.get("SNAPSHOTS_TTL", 300))
 
     try:
         collector = ResticCollector(
@@ -526,6 +634,11 @@ if __name__ == "__main__":
             exporter_disable_locks,
             exporter_include_paths,
             exporter_insecure_tls,
+            exporter_restic_concurrency,
+            exporter_cache_path,
+            exporter_check_ttl,
+            exporter_locks_ttl,
+            exporter_snapshots_ttl,
         )
         REGISTRY.register(collector)
         start_http_server(exporter_port, exporter_address)